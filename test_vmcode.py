@@ -1,4 +1,9 @@
-from vmcode import FunctionBuilder, ENVIRONMENT
+import pickle
+from array import array
+import weakref
+import pytest
+import vmcode
+from vmcode import FunctionBuilder, SysNto1, Sys2to1, ENVIRONMENT
 
 def test_simple_vmcode():
     b = FunctionBuilder()
@@ -37,3 +42,176 @@ def test_lessthan_vmcode():
     assert (True,) == f(1, 2)
     assert (False,) == f(1, 1)
     assert (False,) == f(3, 1)
+
+def test_callq_function_vmcode():
+    b = FunctionBuilder()
+    b.VAR('x').POP('x').PUSH('x').PUSH('x')
+    dup = b.build()
+    b = FunctionBuilder()
+    b.VAR('x').POP('x').PUSHQ('a').PUSH('x').CALLQ(dup).PUSH('x')
+    f = b.build()
+    assert ('a', 1, 1, 1) == f(1)
+
+def test_sys_callq_Nto1_vmcode():
+    b = FunctionBuilder()
+    b.PUSHQ(1).PUSHQ(2).PUSHQ(3).CALLQ(SysNto1(lambda x, y, z: x * 100 + y * 10 + z))
+    f = b.build()
+    assert (0, 123) == f(0)
+
+def test_sys_callq_0to1_vmcode():
+    b = FunctionBuilder()
+    b.CALLQ(SysNto1(lambda: 'z'))
+    f = b.build()
+    assert ('z',) == f()
+
+def test_greaterthan_vmcode():
+    b = FunctionBuilder()
+    b.VARS('x', 'y').POP('y').POP('x')
+    b.PUSH('x').PUSH('y').CALLQ(ENVIRONMENT['>'])
+    f = b.build()
+    assert (False,) == f(1, 2)
+    assert (False,) == f(1, 1)
+    assert (True,) == f(3, 1)
+
+def test_build_cache_vmcode(tmp_path, monkeypatch):
+    monkeypatch.setattr(vmcode, 'CACHE_DIR', tmp_path)
+    assert FunctionBuilder.load('pair') is None
+    b = FunctionBuilder()
+    b.VAR('x').POP('x').PUSHQ('a').PUSH('x')
+    b.build(cache_key='pair')
+    f = FunctionBuilder.load('pair')
+    assert ('a', 1) == f(1)
+
+def test_while_vmcode():
+    b = FunctionBuilder()
+    b.VAR('n').POP('n')
+    b.WHILE().PUSH('n').PUSHQ(0).CALLQ(ENVIRONMENT['>']).DO()
+    b.PUSH('n').PUSH('n').PUSHQ(1).CALLQ(Sys2to1(lambda x, y: x - y)).POP('n')
+    b.ENDWHILE()
+    f = b.build()
+    assert (3, 2, 1) == f(3)
+    assert () == f(0)
+
+def test_unbalanced_vmcode():
+    b = FunctionBuilder()
+    with pytest.raises(RuntimeError):
+        b.THEN()
+    b.WHILE()
+    with pytest.raises(RuntimeError):
+        b.ENDIF()
+
+def test_unclosed_vmcode():
+    b = FunctionBuilder()
+    b.IF().THEN().PUSHQ('a')
+    with pytest.raises(RuntimeError):
+        b.build()
+    b = FunctionBuilder()
+    b.WHILE().PUSHQ(False).DO()
+    with pytest.raises(RuntimeError):
+        b.build()
+
+def test_pushq_interning_vmcode():
+    b = FunctionBuilder()
+    b.PUSHQ('a').PUSHQ(1).PUSHQ(True).PUSHQ('a').PUSHQ([]).PUSHQ([])
+    b.PUSHQ(0.0).PUSHQ(-0.0).PUSHQ((1, True)).PUSHQ((1, 1))
+    f = b.build()
+    result = f()
+    assert ('a', 1, True, 'a', [], [], 0.0, -0.0, (1, True), (1, 1)) == result
+    assert str(result[7]) == '-0.0'
+    assert type(result[9][1]) is int
+    assert 9 == len(f.consts())
+
+def test_call_depth_vmcode():
+    b = FunctionBuilder()
+    b.PUSHQ('a')
+    f = b.build()
+    for _ in range(300):
+        b = FunctionBuilder()
+        b.CALLQ(f)
+        f = b.build()
+    assert ('a',) == f()
+    engine = vmcode.Engine(initial_call_depth=1)
+    engine.callq(f)
+    engine.callq(f)
+    engine.run()
+    assert ('a', 'a') == engine.returnValues()
+
+def test_reentrant_call_vmcode():
+    b = FunctionBuilder()
+    b.VAR('x').POP('x').PUSH('x').PUSH('x')
+    dup = b.build()
+    b = FunctionBuilder()
+    b.VAR('x').POP('x').PUSHQ('a').PUSH('x').CALLQ(SysNto1(lambda x: dup(x)))
+    f = b.build()
+    assert ('a', (1, 1)) == f(1)
+    assert ('a', (2, 2)) == f(2)
+
+def test_build_cache_unpicklable_vmcode(tmp_path, monkeypatch):
+    monkeypatch.setattr(vmcode, 'CACHE_DIR', tmp_path)
+    b = FunctionBuilder()
+    b.PUSHQ('old')
+    b.build(cache_key='k')
+    b = FunctionBuilder()
+    b.CALLQ(SysNto1(lambda: 2))
+    assert (2,) == b.build(cache_key='k')()
+    assert FunctionBuilder.load('k') is None
+    assert [] == list(tmp_path.iterdir())
+
+def test_pooled_engine_releases_values_vmcode():
+    class Obj:
+        pass
+    b = FunctionBuilder()
+    b.PUSHQ('a')
+    inner = b.build()
+    b = FunctionBuilder()
+    b.VAR('x').POP('x').CALLQ(inner).PUSH('x')
+    outer = b.build()
+    obj = Obj()
+    ref = weakref.ref(obj)
+    assert ('a', obj) == outer(obj)
+    del obj
+    assert ref() is None
+
+def test_trace_vmcode(capsys):
+    b = FunctionBuilder()
+    b.PUSHQ('a')
+    inner = b.build()
+    b = FunctionBuilder()
+    b.VAR('x').POP('x').PUSH('x').POP('traced_global')
+    b.IF().PUSH('traced_global').THEN().CALLQ(inner).ELSE().PUSHQ('b').ENDIF()
+    b.PUSHQ(1).PUSHQ(2).CALLQ(ENVIRONMENT['<'])
+    b.PUSHQ(1).PUSHQ(2).CALLQ(ENVIRONMENT['>'])
+    b.PUSHQ(1).PUSHQ(2).CALLQ(Sys2to1(lambda x, y: x + y))
+    b.PUSHQ(1).CALLQ(SysNto1(lambda x: -x))
+    b.CALLQ(SysNto1(lambda: 'z'))
+    f = b.build()
+    for arg, expected in ((True, 'a'), (False, 'b')):
+        engine = vmcode.Engine(trace=True)
+        engine.value_stack.append(arg)
+        engine.callq(f)
+        engine.run()
+        assert (expected, True, False, 3, -1, 'z') == engine.returnValues()
+        assert (expected, True, False, 3, -1, 'z') == f(arg)
+    assert 'PC: 0 CODE: 0' in capsys.readouterr().out
+
+def test_build_cache_rejects_bad_files_vmcode(tmp_path, monkeypatch):
+    monkeypatch.setattr(vmcode, 'CACHE_DIR', tmp_path)
+    b = FunctionBuilder()
+    b.PUSHQ('a')
+    b.build(cache_key='k')
+    data = (tmp_path / 'k.pkl').read_bytes()
+    (tmp_path / 'k.pkl').write_bytes(data[:len(data) // 2])
+    assert FunctionBuilder.load('k') is None
+    (tmp_path / 'k.pkl').write_bytes(pickle.dumps((array('i', [vmcode.OP_ENTER, 0, vmcode.OP_LEAVE]), ())))
+    assert FunctionBuilder.load('k') is None
+    monkeypatch.setattr(vmcode, 'CACHE_VERSION', vmcode.CACHE_VERSION + 1)
+    b = FunctionBuilder()
+    b.PUSHQ('a')
+    b.build(cache_key='k')
+    monkeypatch.setattr(vmcode, 'CACHE_VERSION', vmcode.CACHE_VERSION - 1)
+    assert FunctionBuilder.load('k') is None
+    for key in ('../x', 'a/b', '..', ''):
+        with pytest.raises(RuntimeError):
+            FunctionBuilder.load(key)
+        with pytest.raises(RuntimeError):
+            FunctionBuilder().build(cache_key=key)
@@ -1,123 +1,196 @@
 # Example of a abstract machine interface.
 
 from abc import abstractmethod, ABC
+from array import array
 from inspect import signature
-from collections import deque
-from typing import Deque, Dict, Any
+from pathlib import Path
+import os
+import pickle
+import tempfile
+import threading
+from typing import Dict, Any
 
 
 ENVIRONMENT: Dict[str, Any] = {}
 
+# Where FunctionBuilder.build(cache_key=...) persists compiled functions.
+CACHE_DIR = Path.home() / '.cache' / 'vmcode'
+
+# Stored in every cache file. Bump whenever the opcodes or the code and
+# constant-pool layout change, so that stale cache files are ignored.
+CACHE_VERSION = 2
+
+def _cache_path(cache_key: str) -> Path:
+    if not cache_key or cache_key in ('.', '..') or '/' in cache_key or (os.altsep and os.altsep in cache_key):
+        raise RuntimeError(f'Invalid cache key: {cache_key!r}')
+    return CACHE_DIR / f'{cache_key}.pkl'
+
+# Opcodes. Each is followed in the code by at most one integer operand,
+# which is a jump offset, a local slot or an index into the constant pool.
+OP_ENTER = 0
+OP_LEAVE = 1
+OP_CALLQ = 2
+OP_SYS_CALLQ_NTO1 = 3
+OP_SYS_CALLQ_2TO1 = 4
+OP_SYS_CALLQ_0TO1 = 5
+OP_PUSHQ = 6
+OP_POP_LOCAL = 7
+OP_PUSH_LOCAL = 8
+OP_POP_GLOBAL = 9
+OP_PUSH_GLOBAL = 10
+OP_JUMP = 11
+OP_JUMP_IF_NOT = 12
+OP_LT = 13
+OP_GT = 14
+
 class Engine:
+    __slots__ = ('value_stack', 'code', 'consts', 'pc', 'locals', 'globals', 'dump', 'dump_top', 'trace')
 
-    def __init__(self):
+    def __init__(self, trace=False, initial_call_depth=256):
         self.value_stack = []
         self.code = ()
+        self.consts = ()
         self.pc = 0
-        self.locals = {}
+        self.locals = []
         self.globals = ENVIRONMENT
-        self.dump = []
+        # The dump is preallocated and doubled when full; dump_top is the
+        # index of the next free frame.
+        self.dump = [None] * max(initial_call_depth, 1)
+        self.dump_top = 0
+        self.trace = trace
 
     def run(self):
-        while self.pc < len(self.code):
-            print(f'PC: {self.pc} CODE: {self.code[self.pc]}')
-            L = self.code[self.pc]
-            self.pc += 1
-            L(self)
+        # The machine registers are held in locals for the duration of the
+        # loop and only written back to the engine on exit.
+        code = self.code
+        consts = self.consts
+        pc = self.pc
+        stack = self.value_stack
+        push = stack.append
+        pop = stack.pop
+        local_vars = self.locals
+        global_vars = self.globals
+        dump = self.dump
+        top = self.dump_top
+        dump_size = len(dump)
+        trace = self.trace
+        n = len(code)
+        while pc < n:
+            if trace:
+                print(f'PC: {pc} CODE: {code[pc]}')
+            op = code[pc]
+            pc += 1
+            if op == OP_PUSHQ:
+                push(consts[code[pc]])
+                pc += 1
+            elif op == OP_PUSH_LOCAL:
+                push(local_vars[code[pc]])
+                pc += 1
+            elif op == OP_POP_LOCAL:
+                local_vars[code[pc]] = pop()
+                pc += 1
+            elif op == OP_JUMP_IF_NOT:
+                if not pop():
+                    pc = code[pc]
+                else:
+                    pc += 1
+            elif op == OP_JUMP:
+                pc = code[pc]
+            elif op == OP_PUSH_GLOBAL:
+                push(global_vars[consts[code[pc]]])
+                pc += 1
+            elif op == OP_POP_GLOBAL:
+                global_vars[consts[code[pc]]] = pop()
+                pc += 1
+            elif op == OP_LT:
+                y = pop()
+                x = pop()
+                push(x < y)
+            elif op == OP_GT:
+                y = pop()
+                x = pop()
+                push(x > y)
+            elif op == OP_SYS_CALLQ_2TO1:
+                fn = consts[code[pc]]
+                y = pop()
+                x = pop()
+                push(fn(x, y))
+                pc += 1
+            elif op == OP_SYS_CALLQ_NTO1:
+                fn, nargs = consts[code[pc]]
+                k = len(stack) - nargs
+                args = stack[k:]
+                del stack[k:]
+                push(fn(*args))
+                pc += 1
+            elif op == OP_SYS_CALLQ_0TO1:
+                push(consts[code[pc]]())
+                pc += 1
+            elif op == OP_CALLQ:
+                fn = consts[code[pc]]
+                if top == dump_size:
+                    dump.extend([None] * dump_size)
+                    dump_size = len(dump)
+                dump[top] = (code, consts, pc + 1, local_vars)
+                top += 1
+                code = fn.code()
+                consts = fn.consts()
+                n = len(code)
+                pc = 0
+            elif op == OP_ENTER:
+                local_vars = [None] * code[pc]
+                pc += 1
+            elif op == OP_LEAVE:
+                top -= 1
+                code, consts, pc, local_vars = dump[top]
+                dump[top] = None
+                n = len(code)
+            else:
+                raise RuntimeError(f'Unknown opcode: {op}')
+        self.code = code
+        self.consts = consts
+        self.pc = pc
+        self.locals = local_vars
+        self.dump_top = top
+
+    def reset(self):
+        self.value_stack.clear()
+        # Frames left behind by an aborted run would otherwise keep their
+        # code and locals alive.
+        self.dump[:self.dump_top] = [None] * self.dump_top
+        self.code = ()
+        self.consts = ()
+        self.pc = 0
+        self.locals = []
+        self.dump_top = 0
 
     def returnValues(self):
         return tuple(self.value_stack)
 
     def callq(self, fn: 'Function'):
-        self.dump.append(self.code)
-        self.dump.append(self.pc)
+        if self.dump_top == len(self.dump):
+            self.dump.extend([None] * len(self.dump))
+        self.dump[self.dump_top] = (self.code, self.consts, self.pc, self.locals)
+        self.dump_top += 1
         self.code = fn.code()
+        self.consts = fn.consts()
         self.pc = 0
 
     def sys_callq_Nto1(self, nargs, fn):
-        d: Deque = deque()
-        for _ in range(nargs):
-            d.appendleft(self.value_stack.pop())
-        self.value_stack.append(fn(*d))
+        # Slicing from len - nargs rather than -nargs keeps nargs == 0 safe.
+        k = len(self.value_stack) - nargs
+        args = self.value_stack[k:]
+        del self.value_stack[k:]
+        self.value_stack.append(fn(*args))
 
     def sys_callq_2to1(self, fn):
         y = self.value_stack.pop()
         x = self.value_stack.pop()
         self.value_stack.append(fn(x, y))
 
-    def pushq(self, value):
-        self.value_stack.append(value)
-
-def inst_leave(engine: Engine):
-    engine.locals = engine.dump.pop()
-    engine.pc = engine.dump.pop()
-    engine.code = engine.dump.pop()
-
-def inst_enter(engine: Engine):
-    engine.dump.append(engine.locals)
-    engine.locals = {}
-
-def inst_callq(engine: Engine, fn: 'Function'):
-    engine.dump.append(engine.code)
-    engine.dump.append(engine.pc)
-    engine.code = fn.code()
-    engine.pc = 0
-
-def inst_sys_callq_Nto1(engine: Engine):
-    fn = engine.code[engine.pc]
-    nargs = fn.nargs()
-    d: Deque = deque()
-    for _ in range(nargs):
-        d.appendleft(engine.value_stack.pop())
-    engine.value_stack.push(fn(*d))
-    engine.pc += 1
-
-def inst_sys_callq_2to1(engine: Engine):
-    fn = engine.code[engine.pc]
-    y = engine.value_stack.pop()
-    x = engine.value_stack.pop()
-    engine.value_stack.append(fn(x, y))
-    engine.pc += 1
-
-def inst_sys_callq_0to1(engine: Engine):
-    fn = engine.code[engine.pc]
-    engine.value_stack.push(fn())
-    engine.pc += 1
-
-def inst_pushq(engine: Engine):
-    engine.value_stack.append(engine.code[engine.pc])
-    engine.pc += 1
-
-def inst_pop_local(engine: Engine):
-    name = engine.code[engine.pc]
-    engine.locals[name] = engine.value_stack.pop()
-    engine.pc += 1
-
-def inst_push_local(engine: Engine):
-    name = engine.code[engine.pc]
-    engine.value_stack.append(engine.locals[name])
-    engine.pc += 1
-
-def inst_pop_global(engine: Engine):
-    name = engine.code[engine.pc]
-    engine.globals[name] = engine.value_stack.pop()
-    engine.pc += 1
-
-def inst_push_global(engine: Engine):
-    name = engine.code[engine.pc]
-    engine.value_stack.append(engine.globals[name])
-    engine.pc += 1
-
-def inst_jump(engine: Engine):
-    engine.pc = engine.code[engine.pc]
-
-def inst_jump_if_not(engine: Engine):
-    if not engine.value_stack.pop():
-        engine.pc = engine.code[engine.pc]
-    else:
-        engine.pc += 1
-
 class Procedure(ABC):
+    __slots__ = ()
+
     @abstractmethod
     def callq(self, engine: Engine):
         ...
@@ -131,12 +204,17 @@ class Procedure(ABC):
         ...
 
 class SysFn(Procedure):
+    __slots__ = ('_fn', '_nargs')
 
     def __init__(self, fn):
         self._fn = fn
+        self._nargs = len(signature(fn).parameters)
 
     def nargs(self):
-        return len(signature(self._fn).parameters)
+        return self._nargs
+
+    def function(self):
+        return self._fn
 
     def show(self):
         print(f'SysNto1: {self._fn}')
@@ -145,60 +223,86 @@ class SysFn(Procedure):
         return self._fn(*args)
 
 class SysNto1(SysFn):
-
-    def __init__(self, fn):
-        super().__init__(fn)
-        self._nargs = len(signature(fn).parameters)
-
-    def nargs(self):
-        return self._nargs
+    __slots__ = ()
 
     def callq(self, engine: Engine):
         engine.sys_callq_Nto1(self._nargs, self._fn)
 
 class Sys2to1(SysNto1):
+    __slots__ = ('_opcode',)
+
+    def __init__(self, fn, opcode=None):
+        '''If an opcode is supplied, calls are planted as that (operand-free)
+        opcode instead of a call to fn.'''
+        super().__init__(fn)
+        self._opcode = opcode
 
     def nargs(self):
         return 2
 
+    def opcode(self):
+        return self._opcode
+
     def callq(self, engine: Engine):
         engine.sys_callq_2to1(self._fn)
 
+# Holds at most one idle Engine per thread for reuse by Function.__call__.
+_engine_pool = threading.local()
+
 class Function(Procedure):
+    __slots__ = ('_code', '_consts')
 
     def __init__(self):
         self._code = ()
+        self._consts = ()
 
-    def init_code(self, code):
+    def init_code(self, code, consts):
         '''We need a 2-stage initialisation because of the self-reference in the code.'''
         self._code = code
+        self._consts = consts
 
     def code(self):
         return self._code
 
+    def consts(self):
+        return self._consts
+
     def callq(self, engine: Engine):
         engine.callq(self)
 
     def __call__(self, *args):
-        engine = Engine()
-        for arg in args:
-            engine.pushq(arg)
+        # Take the pooled engine out of the pool while it is running so that
+        # a re-entrant call (e.g. from inside a system function) gets its own.
+        engine = getattr(_engine_pool, 'engine', None)
+        if engine is None:
+            engine = Engine()
+        else:
+            _engine_pool.engine = None
+            engine.reset()
+        engine.value_stack.extend(args)
         engine.callq(self)
         engine.run()
-        return engine.returnValues()
+        result = engine.returnValues()
+        engine.value_stack.clear()
+        _engine_pool.engine = engine
+        return result
 
     def show(self):
         for n, i in enumerate(self._code):
             print(f'{n}: {i}')
+        for n, c in enumerate(self._consts):
+            print(f'CONST {n}: {c}')
 
 class Label:
+    __slots__ = ('_offset', '_dependents')
 
     def __init__(self):
         self._offset = None
         self._dependents = []
 
-    def add_dependent(self, d):
-        self._dependents.append(d)
+    def add_dependent(self, code, index):
+        '''Registers code[index] to be patched with the offset once it is set.'''
+        self._dependents.append((code, index))
 
     def try_get_label(self):
         return self._offset
@@ -211,90 +315,140 @@ class Label:
             raise RuntimeError('Label already set')
         if isinstance(offset, int):
             self._offset = offset
-            for d in self._dependents:
-                d(offset)
+            for code, index in self._dependents:
+                code[index] = offset
             self._dependents = None
         else:
             raise RuntimeError('Label must be a non-negative integer')
 
+# States of the control-structure frames on CodePlanter._nesting.
+AWAIT_THEN = 0
+IN_THEN = 1
+IN_ELSE = 2
+AWAIT_DO = 3
+IN_DO = 4
+
+class IfFrame:
+    __slots__ = ('state', 'endif_label', 'next_case_label')
+
+    def __init__(self, endif_label: Label):
+        self.state = AWAIT_THEN
+        self.endif_label = endif_label
+        self.next_case_label = None
+
+class WhileFrame:
+    __slots__ = ('state', 'startwhile_label', 'endwhile_label')
+
+    def __init__(self, startwhile_label: Label, endwhile_label: Label):
+        self.state = AWAIT_DO
+        self.startwhile_label = startwhile_label
+        self.endwhile_label = endwhile_label
+
+_INTERNABLE_TYPES = frozenset((str, bytes, int, bool, type(None)))
+
 class CodePlanter:
+    __slots__ = ('_code', '_consts', '_const_pool', '_local_slots', '_nesting')
 
     def __init__(self):
-        self._code = []
-        self._local_vars = set()
+        self._code = array('i')
+        self._consts = []
+        self._const_pool: Dict[Any, int] = {}
+        self._local_slots: Dict[str, int] = {}
         self._nesting = []
 
     @abstractmethod
     def build(self):
         ...
 
-    def _send_nesting(self, state):
-        print(f'_send_nesting: {state} {self._nesting}')
+    def _top_nesting(self, frame_class, states, token):
         try:
-            self._nesting[-1].send(state)
+            frame = self._nesting[-1]
         except IndexError as exc:
-            raise RuntimeError(f'Unexpected call of {state}') from exc
-        except StopIteration:
-            self._nesting.pop()
-        return self
+            raise RuntimeError(f'Unexpected call of {token}') from exc
+        if not isinstance(frame, frame_class) or frame.state not in states:
+            raise RuntimeError(f'Unexpected call of {token}')
+        return frame
+
+    def _plant_const(self, value):
+        # Equal constants share a slot only for types where equality means
+        # they are the same value; the type is part of the key so that 1 and
+        # True stay distinct. Everything else (floats, tuples, other objects)
+        # is keyed by identity, e.g. 0.0 == -0.0 and (1, 1) == (1, True).
+        if type(value) in _INTERNABLE_TYPES:
+            key = (type(value), value)
+        else:
+            key = ('id', id(value))
+        idx = self._const_pool.get(key)
+        if idx is None:
+            idx = len(self._consts)
+            self._const_pool[key] = idx
+            self._consts.append(value)
+        self._code.append(idx)
+
+    def _declare_local(self, name: str):
+        if name not in self._local_slots:
+            self._local_slots[name] = len(self._local_slots)
 
     def VAR(self, name: str):
-        self._local_vars.add(name)
+        self._declare_local(name)
         return self
 
     def VARS(self, *names: str):
         for name in names:
-            self._local_vars.add(name)
+            self._declare_local(name)
         return self
 
     def POP(self, name: str):
-        if name in self._local_vars:
-            self._code.append(inst_pop_local)
+        if name in self._local_slots:
+            self._code.append(OP_POP_LOCAL)
+            self._code.append(self._local_slots[name])
         else:
-            self._code.append(inst_pop_global)
-        self._code.append(name)
+            self._code.append(OP_POP_GLOBAL)
+            self._plant_const(name)
         return self
 
     def PUSH(self, name: str):
-        if name in self._local_vars:
-            self._code.append(inst_push_local)
+        if name in self._local_slots:
+            self._code.append(OP_PUSH_LOCAL)
+            self._code.append(self._local_slots[name])
         else:
-            self._code.append(inst_push_global)
-        self._code.append(name)
+            self._code.append(OP_PUSH_GLOBAL)
+            self._plant_const(name)
         return self
 
     def PUSHQ(self, value):
-        self._code.append(inst_pushq)
-        self._code.append(value)
+        self._code.append(OP_PUSHQ)
+        self._plant_const(value)
         return self
 
     def CALLQ(self, fn: Procedure):
         if isinstance(fn, Function):
-            self._code.append(inst_callq)
-            self._code.append(fn)
+            self._code.append(OP_CALLQ)
+            self._plant_const(fn)
+        elif isinstance(fn, Sys2to1) and fn.opcode() is not None:
+            self._code.append(fn.opcode())
         elif isinstance(fn, SysNto1):
             if fn.nargs() == 0:
-                self._code.append(inst_sys_callq_0to1)
+                self._code.append(OP_SYS_CALLQ_0TO1)
+                self._plant_const(fn.function())
             elif fn.nargs() == 2:
-                self._code.append(inst_sys_callq_2to1)
+                self._code.append(OP_SYS_CALLQ_2TO1)
+                self._plant_const(fn.function())
             else:
-                self._code.append(inst_sys_callq_Nto1)
-            self._code.append(fn)
+                # The wrapped function and its arity are planted as a pair so
+                # that the engine calls the function directly.
+                self._code.append(OP_SYS_CALLQ_NTO1)
+                self._plant_const((fn.function(), fn.nargs()))
         else:
             raise RuntimeError(f'Unknown procedure type: {fn}')
         return self
 
-    def _set(self, n, offset):
-        print(f'_set: {n} {offset}')
-        self._code[n] = offset
-
     def _plant_label(self, label: Label):
         if label.is_set_label():
             self._code.append(label.try_get_label())
         else:
-            n = len(self._code)
-            self._code.append(None)
-            label.add_dependent(lambda l: self._set(n, l))
+            label.add_dependent(self._code, len(self._code))
+            self._code.append(0)
 
     def NEW_LABEL(self):
         return Label()
@@ -302,110 +456,122 @@ class CodePlanter:
     def LABEL(self, label: Label):
         label.set_label(len(self._code))
 
-    def _IF(self):
-        state = yield
-        if state != 'THEN':
-            raise RuntimeError(f'Expecting THEN but got: {state}')
-        endif_label = self.NEW_LABEL()
-        next_case_label = self.NEW_LABEL()
-        self._code.append(inst_jump_if_not)
-        self._plant_label(next_case_label)
-
-        while True:
-            state = yield
-            print(f'_IF: {state}')
-            if state == 'ENDIF':
-                break
-            if state == 'ELSE':
-                self._code.append(inst_jump)
-                self._plant_label(endif_label)
-                self.LABEL(next_case_label)
-                state = yield
-                break
-            if state == 'ELSEIF':
-                self._code.append(inst_jump)
-                self._plant_label(endif_label)
-                self.LABEL(next_case_label)
-                state = yield
-                if state != 'THEN':
-                    raise RuntimeError(f'Expecting THEN but got: {state}')
-                next_case_label = self.NEW_LABEL()
-                self._code.append(inst_jump_if_not)
-                self._plant_label(next_case_label)
-            else:
-                raise RuntimeError(f'Expecting ELSE or ELSEIF but got: {state}')
-
-        print(f'_IF should be endif: {state}')
-        if state != 'ENDIF':
-            raise RuntimeError(f'Expecting ENDIF but got: {state}')
-        if not next_case_label.is_set_label():
-            self.LABEL(next_case_label)
-        self.LABEL(endif_label)
-
     def IF(self):
-        g = self._IF()
-        next(g)
-        self._nesting.append(g)
+        self._nesting.append(IfFrame(self.NEW_LABEL()))
         return self
 
     def THEN(self):
-        return self._send_nesting('THEN')
+        frame = self._top_nesting(IfFrame, (AWAIT_THEN,), 'THEN')
+        frame.next_case_label = self.NEW_LABEL()
+        self._code.append(OP_JUMP_IF_NOT)
+        self._plant_label(frame.next_case_label)
+        frame.state = IN_THEN
+        return self
 
     def ELSEIF(self):
-        return self._send_nesting('ELSEIF')
+        frame = self._top_nesting(IfFrame, (IN_THEN,), 'ELSEIF')
+        self._code.append(OP_JUMP)
+        self._plant_label(frame.endif_label)
+        self.LABEL(frame.next_case_label)
+        frame.state = AWAIT_THEN
+        return self
 
     def ELSE(self):
-        return self._send_nesting('ELSE')
+        frame = self._top_nesting(IfFrame, (IN_THEN,), 'ELSE')
+        self._code.append(OP_JUMP)
+        self._plant_label(frame.endif_label)
+        self.LABEL(frame.next_case_label)
+        frame.state = IN_ELSE
+        return self
 
     def ENDIF(self):
-        return self._send_nesting('ENDIF')
+        frame = self._top_nesting(IfFrame, (IN_THEN, IN_ELSE), 'ENDIF')
+        if not frame.next_case_label.is_set_label():
+            self.LABEL(frame.next_case_label)
+        self.LABEL(frame.endif_label)
+        self._nesting.pop()
+        return self
 
-    def _WHILE(self):
+    def WHILE(self):
         startwhile_label = self.NEW_LABEL()
         self.LABEL(startwhile_label)
-
-        state = yield
-        if state != 'DO':
-            raise RuntimeError(f'Expecting DO but got: {state}')
-
-        endwhile_label = self.NEW_LABEL()
-
-        self._code.append(inst_jump_if_not)
-        self._plant_label(endwhile_label)
-
-        state = yield
-        if state != 'ENDWHILE':
-            raise RuntimeError(f'Expecting ENDWHILE but got: {state}')
-
-        self._code.append(inst_jump)
-        self._plant_label(startwhile_label)
-
-        self.LABEL(endwhile_label)
-
-    def WHILE(self):
-        g = self._WHILE()
-        next(g)
-        self._nesting.append(g)
+        self._nesting.append(WhileFrame(startwhile_label, self.NEW_LABEL()))
         return self
 
     def DO(self):
-        return self._send_nesting('DO')
+        frame = self._top_nesting(WhileFrame, (AWAIT_DO,), 'DO')
+        self._code.append(OP_JUMP_IF_NOT)
+        self._plant_label(frame.endwhile_label)
+        frame.state = IN_DO
+        return self
 
     def ENDWHILE(self):
-        return self._send_nesting('ENDWHILE')
+        frame = self._top_nesting(WhileFrame, (IN_DO,), 'ENDWHILE')
+        self._code.append(OP_JUMP)
+        self._plant_label(frame.startwhile_label)
+        self.LABEL(frame.endwhile_label)
+        self._nesting.pop()
+        return self
 
 class FunctionBuilder(CodePlanter):
+    __slots__ = ()
 
     def __init__(self):
         super().__init__()
-        self._code.append(None) # Placeholder
+        self._code.append(0) # Placeholder
+        self._code.append(0) # Placeholder for the number of locals.
+
+    def build(self, cache_key=None):
+        if self._nesting:
+            # Otherwise the unresolved jump placeholders would send control
+            # back to offset 0.
+            raise RuntimeError(f'Unclosed control structure: {type(self._nesting[-1]).__name__}')
+        f = Function()
+        self._code[0] = OP_ENTER  # Tie self-referencial knot.
+        self._code[1] = len(self._local_slots)
+        self._code.append(OP_LEAVE)
+        f.init_code(array('i', self._code), tuple(self._consts))
+        if cache_key is not None:
+            path = _cache_path(cache_key)
+            try:
+                data = pickle.dumps((CACHE_VERSION, f.code(), f.consts()))
+            except (pickle.PicklingError, AttributeError, TypeError):
+                # Constants such as lambdas cannot be persisted; the function
+                # is still usable, it just will not be cached. Any older copy
+                # under this key is stale and must not be loaded.
+                path.unlink(missing_ok=True)
+            else:
+                CACHE_DIR.mkdir(parents=True, exist_ok=True)
+                # Write to a temporary file and rename it into place so that
+                # a concurrent load never sees a partially written pickle.
+                fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'wb') as file:
+                        file.write(data)
+                    os.replace(tmp, path)
+                except BaseException:
+                    os.unlink(tmp)
+                    raise
+        return f
 
-    def build(self):
+    @staticmethod
+    def load(cache_key):
+        '''Returns the function previously built with this cache_key, or None
+        if there is no usable cached copy, so the caller can skip building it.'''
+        try:
+            data = _cache_path(cache_key).read_bytes()
+        except FileNotFoundError:
+            return None
+        try:
+            version, code, consts = pickle.loads(data)
+        except (pickle.UnpicklingError, EOFError, ValueError, TypeError):
+            # Truncated, corrupt or not a cache file at all.
+            return None
+        if version != CACHE_VERSION:
+            return None
         f = Function()
-        self._code[0] = inst_enter  # Tie self-referencial knot.
-        self._code.append(inst_leave)
-        f.init_code(tuple(self._code))
+        f.init_code(code, consts)
         return f
 
-ENVIRONMENT['>'] = Sys2to1(lambda x, y: x > y)
-ENVIRONMENT['<'] = Sys2to1(lambda x, y: x < y)
+ENVIRONMENT['>'] = Sys2to1(lambda x, y: x > y, OP_GT)
+ENVIRONMENT['<'] = Sys2to1(lambda x, y: x < y, OP_LT)